@@ -6,33 +6,338 @@ Against a running ComfyUI instance (local Docker or RunPod).
 
 Usage:
   # Local Docker test
-  python scripts/test-workflow.py --url http://localhost:8188
+  python scripts/test-workflow.py local --url http://localhost:8188
 
   # RunPod test
-  python scripts/test-workflow.py --runpod --api-key YOUR_KEY --endpoint-id YOUR_ID
+  python scripts/test-workflow.py runpod --api-key YOUR_KEY --endpoint-id YOUR_ID
+
+  # RunPod load test — submit 4 jobs at once
+  python scripts/test-workflow.py runpod --api-key YOUR_KEY --endpoint-id YOUR_ID --batch 4
 """
 
 import argparse
-import base64
+import atexit
+import binascii
+import gzip
+import hashlib
 import json
+import random
 import sys
+import tempfile
 import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
-import requests
+try:
+    import orjson
+
+    json_loads = orjson.loads
+    json_dumps = orjson.dumps
+except ImportError:  # stdlib fallback — same results, just slower
+    json_loads = json.loads
+
+    def json_dumps(obj) -> bytes:
+        return json.dumps(obj).encode()
+
+
+# requests/websocket/ijson are imported on first use so `--help` and argument
+# errors return without loading the network stack.
+
+def make_session() -> "requests.Session":
+    """Create a pooled Session so repeated calls reuse one keep-alive connection."""
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    session = requests.Session()
+    retry = Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504])
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=retry)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers["Connection"] = "keep-alive"
+    return session
+
+
+def pin_dns(host: str) -> None:
+    """Resolve host once and reuse that address for every new connection to it.
+
+    TLS still verifies against the hostname — only the lookup is skipped.
+    """
+    import socket
+    import urllib3.util.connection as urllib3_connection
+
+    try:
+        addr = socket.gethostbyname(host)
+    except OSError:
+        return  # let urllib3 resolve (and report) as usual
+    create_connection = urllib3_connection.create_connection
+
+    def pinned_create_connection(address, *args, **kwargs):
+        if address[0] == host:
+            address = (addr, address[1])
+        return create_connection(address, *args, **kwargs)
+
+    urllib3_connection.create_connection = pinned_create_connection
+
+
+_session = None
+
+# One pool for all I/O fan-out (node probes, RunPod jobs + health)
+_EXECUTOR = ThreadPoolExecutor(max_workers=8, thread_name_prefix="comfy-test")
+atexit.register(_EXECUTOR.shutdown, wait=True)
+
+
+def get_session() -> "requests.Session":
+    """Return the shared Session, creating it on first use."""
+    global _session
+    if _session is None:
+        _session = make_session()
+    return _session
+
+
+SEP = "=" * 50
+CLIENT_ID = "test"
+WAIT_TIMEOUT = 180
+RUNPOD_HOST = "api.runpod.ai"
+RUNPOD_TIMEOUT = 300
+RUNPOD_PENDING = ("IN_QUEUE", "IN_PROGRESS")
+REQUIRED_NODES = (
+    "UnetLoaderGGUF",        # ComfyUI-GGUF
+    "FaceDetailer",          # Impact Pack
+    "UpscaleModelLoader",    # Built-in upscale
+)
+REQUIRED_NODE_SET = frozenset(REQUIRED_NODES)
+CACHE_TTL = 60  # seconds; /object_info only changes on server restart
+
+
+def _cache_path(key: str) -> Path:
+    digest = hashlib.md5(key.encode()).hexdigest()
+    return Path(tempfile.gettempdir()) / f"comfyui_test_{digest}.json"
+
+
+def cached_get(url: str, use_cache: bool = True, ttl: int = CACHE_TTL):
+    """GET a JSON endpoint, reusing a recent on-disk copy when available."""
+    path = _cache_path(url)
+    if use_cache:
+        try:
+            if time.time() - path.stat().st_mtime < ttl:
+                return json_loads(path.read_bytes())
+        except (OSError, ValueError):
+            pass
+    resp = get_session().get(url, timeout=10)
+    resp.raise_for_status()
+    data = json_loads(resp.content)
+    try:
+        path.write_bytes(resp.content)
+    except OSError:
+        pass
+    return data
+
+
+def connect_websocket(base_url: str) -> "websocket.WebSocket | None":
+    """Open ComfyUI's /ws event stream, or return None to fall back to polling."""
+    import websocket
+
+    ws_url = base_url.replace("http", "ws", 1).rstrip("/") + f"/ws?clientId={CLIENT_ID}"
+    try:
+        ws = websocket.WebSocket()
+        ws.connect(ws_url, timeout=10)
+        return ws
+    except (websocket.WebSocketException, OSError) as e:
+        print(f"  [WARN] Websocket unavailable ({e}), falling back to polling")
+        return None
+
+
+def fetch_history(base_url: str, prompt_id: str) -> dict | None:
+    """Return the /history entry for prompt_id, or None if it isn't there yet."""
+    resp = get_session().get(f"{base_url}/history/{prompt_id}", timeout=10)
+    hist = json_loads(resp.content)
+    return hist.get(prompt_id)
+
+
+def wait_websocket(base_url: str, ws: "websocket.WebSocket", prompt_id: str) -> dict | None:
+    """Block on websocket events until prompt_id finishes, then fetch its history once."""
+    import websocket
+
+    deadline = time.monotonic() + WAIT_TIMEOUT
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return None
+        ws.settimeout(remaining)
+        try:
+            raw = ws.recv()
+        except websocket.WebSocketTimeoutException:
+            return None
+        except (websocket.WebSocketException, OSError):
+            return poll_history(base_url, prompt_id, deadline)
+        if not isinstance(raw, str):
+            continue  # binary preview frames
+        msg = json_loads(raw)
+        data = msg.get("data", {})
+        if data.get("prompt_id") != prompt_id:
+            continue
+        # ComfyUI signals completion with executing(node=None); errors end the run too
+        if (msg.get("type") == "executing" and data.get("node") is None) or \
+                msg.get("type") in ("execution_success", "execution_error"):
+            break
+    return fetch_history(base_url, prompt_id)
+
+
+def poll_history(base_url: str, prompt_id: str, deadline: float | None = None) -> dict | None:
+    """Poll /history until prompt_id appears or the deadline passes.
+
+    deadline is a time.monotonic() value; the default is WAIT_TIMEOUT from now.
+
+    Backs off exponentially (1s → 8s, with jitter) so short jobs are seen
+    quickly and long jobs don't hammer the server.
+    """
+    import requests
+
+    url = f"{base_url}/history/{prompt_id}"
+    if deadline is None:
+        deadline = time.monotonic() + WAIT_TIMEOUT
+    delay = 1.0
+    etag = None
+    last_digest = None
+    while time.monotonic() < deadline:
+        try:
+            # Skip re-parsing unchanged responses: 304 if the server sends
+            # ETags, otherwise compare a cheap digest of the raw body
+            headers = {"If-None-Match": etag} if etag else {}
+            resp = get_session().get(url, headers=headers, timeout=10)
+            if resp.status_code != 304:
+                etag = resp.headers.get("ETag")
+                digest = hashlib.blake2b(resp.content, digest_size=8).digest()
+                if digest != last_digest:
+                    last_digest = digest
+                    entry = json_loads(resp.content).get(prompt_id)
+                    if entry is not None:
+                        return entry
+        except (requests.RequestException, ValueError):
+            pass
+        time.sleep(delay + random.uniform(0, 0.3))
+        delay = min(delay * 1.5, 8.0)
+    return None
+
+
+def find_required_nodes(base_url: str, use_cache: bool = True) -> frozenset[str]:
+    """Return the subset of REQUIRED_NODES the server has installed."""
+    import requests
+
+    def probe(node_name: str) -> bool:
+        return bool(cached_get(f"{base_url}/object_info/{node_name}", use_cache))
+
+    try:
+        # Query each node schema individually (in parallel) instead of the
+        # multi-MB full /object_info
+        found = _EXECUTOR.map(probe, REQUIRED_NODES)
+        return frozenset(name for name, ok in zip(REQUIRED_NODES, found) if ok)
+    except requests.HTTPError as e:
+        if e.response is None or e.response.status_code != 404:
+            raise
+    # Older ComfyUI has no per-node route — fall back to the full dump
+    try:
+        import ijson
+    except ImportError:
+        nodes = cached_get(f"{base_url}/object_info", use_cache)
+        return REQUIRED_NODE_SET.intersection(nodes.keys())
+
+    # Stream top-level keys only and stop as soon as every required node is seen
+    found = set()
+    with get_session().get(f"{base_url}/object_info", timeout=30, stream=True) as resp:
+        resp.raise_for_status()
+        resp.raw.decode_content = True
+        for prefix, event, value in ijson.parse(resp.raw):
+            if prefix == "" and event == "map_key" and value in REQUIRED_NODE_SET:
+                found.add(value)
+                if found == REQUIRED_NODE_SET:
+                    break
+    return frozenset(found)
+
+
+def save_b64(image_b64: str, out_path: Path, chunk_size: int = 64 * 1024) -> None:
+    """Decode base64 straight into a file in chunks, never holding the full bytes."""
+    chunk_size -= chunk_size % 4  # keep every slice on a base64 quantum boundary
+    with out_path.open("wb") as f:
+        for i in range(0, len(image_b64), chunk_size):
+            f.write(binascii.a2b_base64(image_b64[i:i + chunk_size]))
+
+
+def run_local_workflow(base_url: str, workflow_path: Path) -> None:
+    """Queue a workflow file on a local ComfyUI and report how it finished."""
+    import requests
+
+    try:
+        workflow = json_loads(workflow_path.read_bytes())
+    except FileNotFoundError:
+        print(f"  [SKIP] Workflow file not found: {workflow_path}")
+        return
+    print(f"  Loaded workflow: {workflow_path.name}")
+    print(f"  Nodes: {len(workflow)}")
+
+    # Subscribe before queueing so no progress events are missed
+    ws = connect_websocket(base_url)
+
+    # Queue it (dry run — just check it's accepted)
+    try:
+        # ComfyUI's aiohttp server inflates gzip request bodies transparently
+        body = gzip.compress(
+            json_dumps({"prompt": workflow, "client_id": CLIENT_ID}), compresslevel=3
+        )
+        resp = get_session().post(
+            f"{base_url}/prompt",
+            data=body,
+            headers={"Content-Type": "application/json", "Content-Encoding": "gzip"},
+            timeout=30,
+        )
+        if resp.status_code == 200:
+            prompt_id = json_loads(resp.content).get("prompt_id")
+            print(f"  [OK] Workflow queued: {prompt_id}")
+            print("  Waiting for completion (this may take 30-60s)...")
+
+            start = time.monotonic()
+            if ws is not None:
+                entry = wait_websocket(base_url, ws, prompt_id)
+            else:
+                entry = poll_history(base_url, prompt_id)
+
+            if entry is None:
+                print(f"  [TIMEOUT] Workflow did not complete within {WAIT_TIMEOUT}s")
+            else:
+                status = entry.get("status", {})
+                if status.get("status_str") == "error":
+                    print(f"  [FAIL] Workflow error: {status.get('messages', [])}")
+                else:
+                    outputs = entry.get("outputs", {})
+                    image_count = 0
+                    for v in outputs.values():
+                        image_count += len(v.get("images", ()))
+                    elapsed = time.monotonic() - start
+                    print(f"  [OK] Completed in {elapsed:.1f}s — {image_count} image(s)")
+
+        else:
+            print(f"  [FAIL] Queue rejected: {resp.status_code} — {resp.text[:200]}")
+    except (requests.RequestException, ValueError) as e:
+        print(f"  [FAIL] Could not queue: {e}")
+    finally:
+        if ws is not None:
+            ws.close()
 
 
-def test_local(base_url: str) -> None:
+def test_local(base_url: str, use_cache: bool = True) -> None:
     """Test against local ComfyUI instance."""
-    print(f"Testing local ComfyUI at {base_url}")
-    print("=" * 50)
+    import requests
+
+    print(f"Testing local ComfyUI at {base_url}\n{SEP}")
 
     # Health check
     print("[1/4] Health check...")
     try:
-        resp = requests.get(f"{base_url}/system_stats", timeout=10)
+        # Always live: a cached body would report OK with ComfyUI down
+        resp = get_session().get(f"{base_url}/system_stats", timeout=10)
         resp.raise_for_status()
-        stats = resp.json()
+        stats = json_loads(resp.content)
         devices = stats.get("devices", [{}])
         if devices:
             gpu = devices[0]
@@ -41,101 +346,65 @@ def test_local(base_url: str) -> None:
             vram_free = gpu.get("vram_free", 0) / (1024**3)
             print(f"  VRAM: {vram_free:.1f} / {vram_total:.1f} GB free")
         print("  [OK] ComfyUI is running")
-    except requests.RequestException as e:
+    except (requests.RequestException, ValueError) as e:
         print(f"  [FAIL] Cannot connect: {e}")
         sys.exit(1)
 
     # Check available models
     print("\n[2/4] Checking models...")
     try:
-        # Check object_info for available node types
-        resp = requests.get(f"{base_url}/object_info", timeout=30)
-        resp.raise_for_status()
-        nodes = resp.json()
-
-        required_nodes = [
-            "UnetLoaderGGUF",        # ComfyUI-GGUF
-            "FaceDetailer",          # Impact Pack
-            "UpscaleModelLoader",    # Built-in upscale
-        ]
+        present = find_required_nodes(base_url, use_cache)
+        print("\n".join(
+            f"  [{'OK' if node_name in present else 'MISSING'}] {node_name}"
+            for node_name in REQUIRED_NODES
+        ))
 
-        for node_name in required_nodes:
-            status = "OK" if node_name in nodes else "MISSING"
-            print(f"  [{status}] {node_name}")
-
-    except requests.RequestException as e:
+    except (requests.RequestException, ValueError) as e:
         print(f"  [WARN] Could not check nodes: {e}")
 
     # Test generate workflow
     print("\n[3/4] Testing generate workflow...")
     workflow_path = Path(__file__).parent.parent / "workflows" / "txt2img-face-lora.json"
-    if workflow_path.exists():
-        with open(workflow_path) as f:
-            workflow = json.load(f)
-        print(f"  Loaded workflow: {workflow_path.name}")
-        print(f"  Nodes: {len(workflow)}")
-
-        # Queue it (dry run — just check it's accepted)
-        try:
-            resp = requests.post(
-                f"{base_url}/prompt",
-                json={"prompt": workflow, "client_id": "test"},
-                timeout=30,
-            )
-            if resp.status_code == 200:
-                prompt_id = resp.json().get("prompt_id")
-                print(f"  [OK] Workflow queued: {prompt_id}")
-                print("  Waiting for completion (this may take 30-60s)...")
-
-                # Poll for completion
-                start = time.time()
-                while time.time() - start < 180:
-                    try:
-                        hist = requests.get(
-                            f"{base_url}/history/{prompt_id}", timeout=10
-                        ).json()
-                        if prompt_id in hist:
-                            status = hist[prompt_id].get("status", {})
-                            if status.get("status_str") == "error":
-                                print(f"  [FAIL] Workflow error: {status.get('messages', [])}")
-                            else:
-                                outputs = hist[prompt_id].get("outputs", {})
-                                image_count = sum(
-                                    len(v.get("images", []))
-                                    for v in outputs.values()
-                                )
-                                elapsed = time.time() - start
-                                print(f"  [OK] Completed in {elapsed:.1f}s — {image_count} image(s)")
-                            break
-                    except requests.RequestException:
-                        pass
-                    time.sleep(2)
-                else:
-                    print("  [TIMEOUT] Workflow did not complete within 180s")
-
-            else:
-                print(f"  [FAIL] Queue rejected: {resp.status_code} — {resp.text[:200]}")
-        except requests.RequestException as e:
-            print(f"  [FAIL] Could not queue: {e}")
-    else:
-        print(f"  [SKIP] Workflow file not found: {workflow_path}")
+    run_local_workflow(base_url, workflow_path)
 
     # Summary
-    print("\n[4/4] Summary")
-    print("=" * 50)
-    print("  Local test complete. Check output/ for generated images.")
+    print(f"\n[4/4] Summary\n{SEP}\n  Local test complete. Check output/ for generated images.")
+
+
+def run_job(base_url: str, payload: dict) -> dict:
+    """Submit a job via async /run, then poll /status with exponential backoff."""
+    resp = get_session().post(f"{base_url}/run", json=payload, timeout=30)
+    resp.raise_for_status()
+    result = json_loads(resp.content)
+    job_id = result.get("id")
+    if job_id is None:
+        return result  # rejected at submit time (bad key, invalid input)
+
+    delay = 1.0
+    deadline = time.monotonic() + RUNPOD_TIMEOUT
+    while time.monotonic() < deadline:
+        if result.get("status") not in RUNPOD_PENDING:
+            return result
+        time.sleep(delay)
+        delay = min(delay * 2, 10.0)
+        resp = get_session().get(f"{base_url}/status/{job_id}", timeout=10)
+        resp.raise_for_status()
+        result = json_loads(resp.content)
+    return result
 
 
-def test_runpod(api_key: str, endpoint_id: str) -> None:
+def test_runpod(api_key: str, endpoint_id: str, batch: int = 1) -> None:
     """Test against RunPod serverless endpoint."""
-    print(f"Testing RunPod endpoint: {endpoint_id}")
-    print("=" * 50)
+    import requests
 
-    base_url = f"https://api.runpod.ai/v2/{endpoint_id}"
-    headers = {"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"}
+    print(f"Testing RunPod endpoint: {endpoint_id}\n{SEP}")
+
+    base_url = f"https://{RUNPOD_HOST}/v2/{endpoint_id}"
+    pin_dns(RUNPOD_HOST)
+    get_session().headers.update(
+        {"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"}
+    )
 
-    # Test generate
-    print("[1/2] Testing generate endpoint...")
     payload = {
         "input": {
             "action": "generate",
@@ -152,68 +421,85 @@ def test_runpod(api_key: str, endpoint_id: str) -> None:
         }
     }
 
+    # Jobs go through async /run + /status so no connection is held open for
+    # the whole generation; health is independent and runs alongside them
+    fut_health = _EXECUTOR.submit(get_session().get, f"{base_url}/health", timeout=10)
+    fut_jobs = [_EXECUTOR.submit(run_job, base_url, payload) for _ in range(batch)]
+
+    # Health check
+    print("[1/2] Endpoint health...")
     try:
-        # Submit job
-        resp = requests.post(f"{base_url}/runsync", json=payload, headers=headers, timeout=300)
-        resp.raise_for_status()
-        result = resp.json()
+        health = json_loads(fut_health.result().content)
+        workers = health.get("workers", {})
+        print(
+            f"  Ready: {workers.get('ready', 0)}\n"
+            f"  Running: {workers.get('running', 0)}\n"
+            f"  Throttled: {workers.get('throttled', 0)}"
+        )
+    except (requests.RequestException, ValueError) as e:
+        print(f"  [WARN] {e}")
+
+    # Test generate
+    print(f"\n[2/2] Testing generate endpoint ({batch} job(s))...")
+    saved = 0
+    for fut in fut_jobs:
+        try:
+            result = fut.result()
+        except (requests.RequestException, ValueError) as e:
+            print(f"  [FAIL] {e}")
+            continue
 
         status = result.get("status")
+        job_id = result.get("id")
         if status == "COMPLETED":
             output = result.get("output", {})
             images = output.get("images", [])
-            print(f"  [OK] Generated {len(images)} image(s)")
+            print(f"  [OK] Job {job_id}: generated {len(images)} image(s)")
 
-            # Save first image
-            if images:
-                img_bytes = base64.b64decode(images[0])
-                out_path = Path("output/runpod_test.png")
+            # Save images
+            for image_b64 in images:
+                suffix = f"_{saved}" if saved else ""
+                out_path = Path(f"output/runpod_test{suffix}.png")
                 out_path.parent.mkdir(exist_ok=True)
-                out_path.write_bytes(img_bytes)
+                save_b64(image_b64, out_path)
+                saved += 1
                 print(f"  Saved to: {out_path}")
         elif status == "FAILED":
-            print(f"  [FAIL] {result.get('error', 'Unknown error')}")
+            print(f"  [FAIL] Job {job_id}: {result.get('error', 'Unknown error')}")
+        elif job_id is None:
+            print(f"  [FAIL] Job not accepted: {result.get('error', result)}")
         else:
             print(f"  [INFO] Status: {status}")
-            job_id = result.get("id")
             if job_id:
                 print(f"  Job ID: {job_id} — poll with /status/{job_id}")
 
-    except requests.RequestException as e:
-        print(f"  [FAIL] {e}")
-
-    # Health check
-    print("\n[2/2] Endpoint health...")
-    try:
-        resp = requests.get(f"{base_url}/health", headers=headers, timeout=10)
-        health = resp.json()
-        workers = health.get("workers", {})
-        print(f"  Ready: {workers.get('ready', 0)}")
-        print(f"  Running: {workers.get('running', 0)}")
-        print(f"  Throttled: {workers.get('throttled', 0)}")
-    except requests.RequestException as e:
-        print(f"  [WARN] {e}")
-
-    print("\n" + "=" * 50)
-    print("RunPod test complete.")
+    print(f"\n{SEP}\nRunPod test complete.")
 
 
 def main() -> None:
     parser = argparse.ArgumentParser(description="Test AI Influencer Pipeline")
-    parser.add_argument("--url", default="http://localhost:8188", help="Local ComfyUI URL")
-    parser.add_argument("--runpod", action="store_true", help="Test RunPod endpoint")
-    parser.add_argument("--api-key", help="RunPod API key")
-    parser.add_argument("--endpoint-id", help="RunPod endpoint ID")
+    sub = parser.add_subparsers(dest="mode", required=True)
+
+    sp_local = sub.add_parser("local", help="Test a local ComfyUI instance")
+    sp_local.add_argument("--url", default="http://localhost:8188", help="Local ComfyUI URL")
+    sp_local.add_argument("--no-cache", action="store_true", help="Bypass cached node probes")
+
+    sp_runpod = sub.add_parser("runpod", help="Test a RunPod serverless endpoint")
+    sp_runpod.add_argument("--api-key", required=True, help="RunPod API key")
+    sp_runpod.add_argument("--endpoint-id", required=True, help="RunPod endpoint ID")
+    sp_runpod.add_argument("--batch", type=int, default=1, help="Number of RunPod jobs to submit in parallel")
 
     args = parser.parse_args()
 
-    if args.runpod:
-        if not args.api_key or not args.endpoint_id:
-            print("Error: --api-key and --endpoint-id required for RunPod test")
-            sys.exit(1)
-        test_runpod(args.api_key, args.endpoint_id)
-    else:
-        test_local(args.url)
+    dispatch = {
+        "local": lambda a: test_local(a.url, use_cache=not a.no_cache),
+        "runpod": lambda a: test_runpod(a.api_key, a.endpoint_id, batch=max(a.batch, 1)),
+    }
+    try:
+        dispatch[args.mode](args)
+    finally:
+        if _session is not None:
+            _session.close()
 
 
 if __name__ == "__main__":
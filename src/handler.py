@@ -19,20 +19,64 @@ Flux 1 Dev FP8 Architecture:
 """
 
 import json
+import re
 import time
+import functools
+import itertools
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
 import uuid
-import base64
-import urllib.request
+import hashlib
+import fcntl
+import shutil
 import urllib.error
-import urllib.parse
+import urllib.request
 from io import BytesIO
 
 import os
-import runpod
-from PIL import Image
+import urllib3
+import websocket
+
+try:
+    import orjson
+
+    json_loads = orjson.loads
+    json_dumps = orjson.dumps
+except ImportError:  # stdlib fallback — same results, just slower
+    json_loads = json.loads
+
+    def json_dumps(obj) -> bytes:
+        return json.dumps(obj).encode()
+
+try:
+    import pybase64 as base64  # SIMD codec, same API as stdlib base64
+except ImportError:
+    import base64
 
 COMFYUI_URL = "http://127.0.0.1:8188"
+COMFYUI_INPUT_DIR = "/comfyui/input"
 TIMEOUT_SECONDS = 600
+STALL_SECONDS = 90  # minimum silence before a started prompt counts as hung
+DEBUG = os.environ.get("INFLUENCER_DEBUG", "0") == "1"
+# Poll fast at first so short jobs aren't held back by a coarse interval,
+# then back off so long jobs don't hammer /history
+POLL_MIN_DELAY = 0.05
+POLL_MAX_DELAY = 2.0
+POLL_BACKOFF = 1.5
+# One websocket/prompt client ID per worker; events are filtered by prompt_id
+_CLIENT_ID = str(uuid.uuid4())
+DEPTH_CKPT = "depth_anything_v2_vitl.pth"  # shared so ComfyUI's model cache hits
+
+# Checkpoint names for injected loader nodes, kept in one place so every
+# request emits the same loader inputs.
+CONTROLNET_NAME = "flux-controlnet-union-pro-2.0.safetensors"
+PULID_FILE = "pulid_flux_v0.9.1.safetensors"
+
+# Shared keep-alive pool for all ComfyUI traffic (single localhost host)
+_http = urllib3.PoolManager(num_pools=1, maxsize=8, headers={"Connection": "keep-alive"})
+
+# Worker threads for per-request I/O fan-out (image downloads/encodes)
+_io_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="comfy-io")
 
 
 def debug_log(msg):
@@ -44,54 +88,256 @@ def debug_log(msg):
 # ComfyUI API helpers
 # ──────────────────────────────────────────────
 
-def queue_prompt(workflow: dict) -> str:
+def queue_prompt(workflow: dict, client_id: str) -> str:
     """Queue a workflow and return the prompt_id."""
-    client_id = str(uuid.uuid4())
-    payload = json.dumps({"prompt": workflow, "client_id": client_id}).encode()
-    req = urllib.request.Request(
+    payload = json_dumps({"prompt": workflow, "client_id": client_id})
+    resp = _http.request(
+        "POST",
         f"{COMFYUI_URL}/prompt",
-        data=payload,
+        body=payload,
         headers={"Content-Type": "application/json"},
+        timeout=30.0,
     )
+    if resp.status >= 400:
+        body = resp.data.decode("utf-8", errors="replace")
+        debug_log(f"ComfyUI REJECTED workflow ({resp.status}): {body[:500]}")
+        raise RuntimeError(f"ComfyUI rejected workflow ({resp.status}): {body}")
     try:
-        resp = urllib.request.urlopen(req, timeout=30)
-    except urllib.error.HTTPError as e:
-        body = e.read().decode("utf-8", errors="replace")
-        debug_log(f"ComfyUI REJECTED workflow ({e.code}): {body[:500]}")
-        raise RuntimeError(f"ComfyUI rejected workflow ({e.code}): {body}") from e
-    result = json.loads(resp.read())
-    debug_log(f"queue_prompt OK: prompt_id={result.get('prompt_id', '?')}")
-    return result["prompt_id"]
+        prompt_id = json_loads(resp.data)["prompt_id"]
+    except (ValueError, KeyError, TypeError):
+        body = resp.data.decode("utf-8", errors="replace")
+        raise RuntimeError(f"ComfyUI rejected workflow ({resp.status}): {body[:500]}") from None
+    debug_log(f"queue_prompt OK: prompt_id={prompt_id}")
+    return prompt_id
+
+
+def fetch_history(prompt_id: str) -> dict | None:
+    """Return the /history entry for prompt_id, or None if not finished yet.
+
+    Raises ValueError if ComfyUI sends a truncated or non-JSON body.
+    """
+    resp = _http.request("GET", f"{COMFYUI_URL}/history/{prompt_id}", timeout=10.0)
+    history = json_loads(resp.data) if resp.status == 200 else {}
+    return history.get(prompt_id)
 
 
 def poll_completion(prompt_id: str) -> dict:
     """Poll until prompt completes or times out. Returns output info."""
-    start = time.time()
+    start = time.monotonic()
     poll_count = 0
-    while time.time() - start < TIMEOUT_SECONDS:
+    delay = POLL_MIN_DELAY
+    while time.monotonic() - start < TIMEOUT_SECONDS:
         poll_count += 1
         try:
-            resp = urllib.request.urlopen(
-                f"{COMFYUI_URL}/history/{prompt_id}", timeout=10
-            )
-            history = json.loads(resp.read())
-            if prompt_id in history:
-                elapsed = time.time() - start
+            entry = fetch_history(prompt_id)
+            if entry is not None:
+                elapsed = time.monotonic() - start
                 debug_log(f"Workflow completed in {elapsed:.1f}s ({poll_count} polls)")
-                return history[prompt_id]
-        except urllib.error.URLError:
-            pass
+                return entry
+        except (urllib3.exceptions.HTTPError, ValueError) as e:
+            debug_log(f"History poll failed ({type(e).__name__}: {e}), retrying")
         if poll_count % 10 == 0:
-            elapsed = time.time() - start
+            elapsed = time.monotonic() - start
             debug_log(f"Still waiting... {elapsed:.0f}s elapsed ({poll_count} polls)")
-        time.sleep(1.5)
+        time.sleep(delay)
+        delay = min(delay * POLL_BACKOFF, POLL_MAX_DELAY)
     debug_log(f"TIMEOUT after {TIMEOUT_SECONDS}s ({poll_count} polls)")
     raise TimeoutError(f"Workflow did not complete within {TIMEOUT_SECONDS}s")
 
 
-def get_output_images(history: dict) -> list[str]:
-    """Extract base64 images from workflow history output."""
-    images = []
+def interrupt_prompt() -> None:
+    """Ask ComfyUI to abort the running prompt so the GPU frees up for the next job."""
+    try:
+        _http.request("POST", f"{COMFYUI_URL}/interrupt", timeout=5.0)
+    except urllib3.exceptions.HTTPError as e:
+        debug_log(f"Interrupt failed: {e}")
+
+
+def open_websocket(client_id: str):
+    """Connect to ComfyUI's /ws event stream; returns None if unavailable."""
+    ws_url = COMFYUI_URL.replace("http", "ws", 1) + f"/ws?clientId={client_id}"
+    try:
+        ws = websocket.WebSocket()
+        ws.connect(ws_url, timeout=10)
+        return ws
+    except (websocket.WebSocketException, OSError) as e:
+        debug_log(f"WebSocket unavailable ({e}), falling back to HTTP polling")
+        return None
+
+
+# Per-worker event stream, opened on first use and kept across requests
+_ws = None
+
+
+def get_websocket():
+    """Return the worker's ComfyUI websocket, reconnecting if it was closed."""
+    global _ws
+    if _ws is None or not _ws.connected:
+        _ws = open_websocket(_CLIENT_ID)
+    return _ws
+
+
+def wait_for_completion(ws, prompt_id: str) -> dict:
+    """Block on websocket events until prompt_id finishes, then fetch history once.
+
+    ComfyUI signals the end of a prompt with an `executing` message whose
+    node is None. Falls back to poll_completion if the socket drops.
+
+    While a node is reporting sampling progress, going silent for
+    max(STALL_SECONDS, 2 × its average step time) is treated as a hang.
+    The limit is disarmed whenever the next node starts executing;
+    TIMEOUT_SECONDS stays the hard ceiling.
+    """
+    start = time.monotonic()
+    last_event = start
+    first_progress = None
+    steps_seen = 0
+    stall_limit = None
+    while True:
+        now = time.monotonic()
+        remaining = TIMEOUT_SECONDS - (now - start)
+        if remaining <= 0:
+            break
+        wait = remaining
+        if stall_limit is not None:
+            idle_left = stall_limit - (now - last_event)
+            if idle_left <= 0:
+                debug_log(f"STALLED: no progress for {now - last_event:.0f}s (websocket)")
+                interrupt_prompt()
+                raise TimeoutError(f"Workflow stalled: no progress for {now - last_event:.0f}s")
+            wait = min(wait, idle_left)
+        ws.settimeout(wait)
+        try:
+            raw = ws.recv()
+            if raw == "":
+                raise websocket.WebSocketConnectionClosedException("closed by server")
+        except websocket.WebSocketTimeoutException:
+            continue  # re-check the hard and stall deadlines
+        except (websocket.WebSocketException, OSError) as e:
+            debug_log(f"WebSocket dropped ({e}), falling back to HTTP polling")
+            ws.close()  # get_websocket() reconnects on the next request
+            return poll_completion(prompt_id)
+        if not isinstance(raw, str):
+            continue  # binary latent previews
+        try:
+            msg = json_loads(raw)
+        except ValueError:
+            continue  # malformed frame; the history fetch has the final word
+        data = msg.get("data", {})
+        if data.get("prompt_id") != prompt_id:
+            continue
+        last_event = time.monotonic()
+        if msg.get("type") == "executing" and data.get("node") is not None:
+            # New node: loaders, VAE decode, upscales etc. may stay silent for
+            # a long time, so only a node that reports progress is watched
+            first_progress = None
+            steps_seen = 0
+            stall_limit = None
+        elif msg.get("type") == "progress":
+            if first_progress is None:
+                first_progress = last_event
+            else:
+                steps_seen += 1
+                avg_step = (last_event - first_progress) / steps_seen
+                stall_limit = max(STALL_SECONDS, 2 * avg_step)
+            if stall_limit is None:
+                stall_limit = STALL_SECONDS
+        if (msg.get("type") == "executing" and data.get("node") is None) or \
+                msg.get("type") == "execution_error":
+            try:
+                entry = fetch_history(prompt_id)
+            except (urllib3.exceptions.HTTPError, ValueError):
+                entry = None
+            if entry is None:
+                # History is written right after the event; poll briefly
+                return poll_completion(prompt_id)
+            debug_log(f"Workflow completed in {time.monotonic() - start:.1f}s (websocket)")
+            return entry
+    debug_log(f"TIMEOUT after {TIMEOUT_SECONDS}s (websocket)")
+    raise TimeoutError(f"Workflow did not complete within {TIMEOUT_SECONDS}s")
+
+
+_B64_CHUNK = 3 * 65536  # multiple of 3 so chunk encodings concatenate cleanly
+
+
+def _fetch_and_encode(filename: str, subfolder: str, img_type: str,
+                      output_format: str = "jpeg", quality: int = 93) -> str:
+    """Download one output image from /view and return it base64-encoded.
+
+    output_format="png" passes ComfyUI's PNG bytes through untouched;
+    anything else re-encodes to JPEG at the given quality.
+    """
+    fields = {"filename": filename, "subfolder": subfolder, "type": img_type}
+    resp = _http.request(
+        "GET",
+        f"{COMFYUI_URL}/view",
+        fields=fields,
+        timeout=30.0,
+        preload_content=False,
+    )
+    if resp.status != 200:
+        try:
+            detail = resp.read(512).decode("utf-8", "replace").strip()
+            resp.drain_conn()  # finish the body so the connection can be reused
+        finally:
+            resp.release_conn()
+        raise RuntimeError(f"/view failed ({resp.status}): {detail[:200]}")
+    if output_format == "png":
+        # Encode as the body streams in; the raw PNG is never held whole
+        out = bytearray()
+        carry = b""
+        try:
+            while True:
+                chunk = resp.read(_B64_CHUNK)
+                if not chunk:
+                    break
+                data = carry + chunk
+                cut = len(data) - len(data) % 3
+                out += base64.b64encode(data[:cut])
+                carry = data[cut:]
+        finally:
+            resp.release_conn()
+        out += base64.b64encode(carry)
+        return out.decode("ascii")
+
+    from PIL import Image  # deferred: only needed once a job has produced output
+
+    try:
+        # urllib3 responses aren't seekable, so Image.open reads the whole
+        # body into its own BytesIO; this still copies the PNG once
+        img = Image.open(resp)
+        img.load()
+    finally:
+        resp.release_conn()
+    # Convert PNG → JPEG for realistic compression artifacts
+    if img.mode == "RGBA":
+        rgb = img.convert("RGB")
+        img.close()
+        img = rgb
+    jpeg_buf = BytesIO()
+    try:
+        img.save(jpeg_buf, format="JPEG", quality=quality, optimize=False, progressive=False)
+    finally:
+        # Free decoded pixels now rather than whenever the pool thread's
+        # frame is collected; a 4K RGBA frame is ~32 MB
+        img.close()
+    with jpeg_buf:
+        return base64.b64encode(jpeg_buf.getbuffer()).decode("ascii")
+
+
+def get_output_images(history: dict, params: dict | None = None) -> list[str]:
+    """Extract base64 images from workflow history output.
+
+    params may set output_format ("jpeg" default, or "png") and quality
+    (JPEG quality 1-100, clamped; default 93).
+
+    Images are fetched and re-encoded concurrently (Pillow releases the GIL
+    in its codecs); output order matches the history order.
+    """
+    params = params or {}
+    output_format = str(params.get("output_format", "jpeg")).lower()
+    quality = min(100, max(1, int(params.get("quality", 93))))
+    tasks = []
     outputs = history.get("outputs", {})
     debug_log(f"get_output_images: {len(outputs)} output nodes: {list(outputs.keys())}")
     for node_id, node_output in outputs.items():
@@ -99,123 +345,240 @@ def get_output_images(history: dict) -> list[str]:
             continue
         debug_log(f"  Node {node_id}: {len(node_output['images'])} images")
         for img_info in node_output["images"]:
-            filename = img_info.get("filename", "")
-            subfolder = img_info.get("subfolder", "")
-            img_type = img_info.get("type", "output")
-
-            params = urllib.parse.urlencode(
-                {"filename": filename, "subfolder": subfolder, "type": img_type}
-            )
-            resp = urllib.request.urlopen(
-                f"{COMFYUI_URL}/view?{params}", timeout=30
-            )
-            img_bytes = resp.read()
-            # Convert PNG → JPEG for realistic compression artifacts
-            img = Image.open(BytesIO(img_bytes))
-            if img.mode == "RGBA":
-                img = img.convert("RGB")
-            jpeg_buf = BytesIO()
-            img.save(jpeg_buf, format="JPEG", quality=93)
-            images.append(base64.b64encode(jpeg_buf.getvalue()).decode("utf-8"))
-    return images
-
-
-def load_workflow(name: str) -> dict:
-    """Load a workflow JSON file."""
+            tasks.append((
+                img_info.get("filename", ""),
+                img_info.get("subfolder", ""),
+                img_info.get("type", "output"),
+                output_format,
+                quality,
+            ))
+    if len(tasks) <= 1:
+        return [_fetch_and_encode(*task) for task in tasks]
+    return list(_io_pool.map(lambda task: _fetch_and_encode(*task), tasks))
+
+
+@functools.lru_cache(maxsize=8)
+def _load_workflow_raw(name: str) -> bytes:
+    """Read a workflow template from disk once per worker; returns its raw JSON."""
     paths = [
         f"/workflows/{name}.json",
         f"/comfyui/workflows/{name}.json",
     ]
     for path in paths:
         try:
-            with open(path) as f:
-                wf = json.load(f)
-                debug_log(f"Loaded workflow '{name}' from {path} ({len(wf)} nodes)")
-                return wf
+            with open(path, "rb") as f:
+                raw = f.read()
+                debug_log(f"Loaded workflow '{name}' from {path}")
+                return raw
         except FileNotFoundError:
             debug_log(f"Workflow not found at {path}")
             continue
     raise FileNotFoundError(f"Workflow '{name}' not found in {paths}")
 
 
+def load_workflow(name: str) -> dict:
+    """Load a fresh, mutable copy of a workflow template.
+
+    Templates are cached as raw JSON; parsing it per call is cheaper than
+    deepcopy and guarantees builders never mutate the cached template.
+    """
+    return json_loads(_load_workflow_raw(name))
+
+
+@functools.lru_cache(maxsize=8)
+def _template_index(name: str) -> dict[str, tuple[str, ...]]:
+    """Map class_type -> template node IDs, computed once per template.
+
+    "positive_prompt" holds the CLIPTextEncode nodes whose title marks them
+    as the positive prompt. Only template nodes are indexed, so the builders
+    use it for nodes that injection helpers never add.
+    """
+    index: dict[str, list[str]] = defaultdict(list)
+    for node_id, node in json_loads(_load_workflow_raw(name)).items():
+        class_type = node.get("class_type", "")
+        index[class_type].append(node_id)
+        if class_type == "CLIPTextEncode" and "positive" in node.get("_meta", {}).get("title", "").lower():
+            index["positive_prompt"].append(node_id)
+    return {k: tuple(v) for k, v in index.items()}
+
+
+# ──────────────────────────────────────────────
+# Graph rewiring: reverse edge index
+# ──────────────────────────────────────────────
+
+def _index_nodes(idx: dict, wf: dict, node_ids) -> None:
+    """Add the link inputs of node_ids to the reverse edge index."""
+    for node_id in node_ids:
+        for key, val in wf[node_id].get("inputs", {}).items():
+            if isinstance(val, list) and len(val) == 2:
+                idx[(val[0], val[1])].append((node_id, key))
+
+
+def _build_edge_index(wf: dict) -> defaultdict:
+    """Map each (source_node, output_index) to the (node_id, input_key) pairs that consume it."""
+    idx = defaultdict(list)
+    _index_nodes(idx, wf, wf.keys())
+    return idx
+
+
+def _rewire(wf: dict, idx: dict, old: tuple, new: tuple,
+            class_types: tuple = (), keys: tuple = ()) -> None:
+    """Point every consumer of output `old` at output `new`.
+
+    Only touches the edges recorded for `old` instead of rescanning the whole
+    workflow. Optionally restricted to consumers of the given class_types /
+    input keys; non-matching edges stay indexed under `old`.
+    """
+    kept = []
+    for node_id, key in idx.pop(old, []):
+        node = wf[node_id]
+        inputs = node["inputs"]
+        if inputs.get(key) != [old[0], old[1]]:
+            continue  # stale entry — input was reassigned directly
+        if (class_types and node.get("class_type") not in class_types) or (keys and key not in keys):
+            kept.append((node_id, key))
+            continue
+        inputs[key] = [new[0], new[1]]
+        idx[new].append((node_id, key))
+    if kept:
+        idx[old] = kept
+
+
+def _add_depth(wf: dict, image_node: str, node_id: str, title: str,
+               resolution: int = 1024) -> str:
+    """Add a DepthAnythingV2 node for image_node under node_id and return node_id.
+
+    Every depth pass uses DEPTH_CKPT so ControlNet-depth, OpticalRealism and
+    warmup all load the same checkpoint.
+    """
+    wf[node_id] = {
+        "class_type": "DepthAnythingV2Preprocessor",
+        "inputs": {"image": [image_node, 0], "ckpt_name": DEPTH_CKPT, "resolution": resolution},
+        "_meta": {"title": title},
+    }
+    return node_id
+
+
 # ──────────────────────────────────────────────
 # Post-processing: Optical Realism + Color Grading
 # ──────────────────────────────────────────────
 
+# Per-request overridable post-processing inputs: node input → (param name, default)
+OPTICAL_PARAMS = {
+    "haze_strength": ("haze_strength", 0.10),
+    "lift_blacks": ("lift_blacks", 0.06),
+    "light_wrap_strength": ("light_wrap_strength", 0.15),
+    "chromatic_aberration": ("chromatic_aberration", 0.004),
+    "vignette_intensity": ("vignette_intensity", 0.10),
+    "grain_power": ("grain_intensity", 0.008),
+    "highlight_rolloff": ("highlight_rolloff", 0.04),
+}
+COLOR_PARAMS = {
+    "temperature": ("color_temperature", 6.0),
+    "contrast": ("color_contrast", 1.04),
+    "saturation": ("color_saturation", 0.93),
+    "gamma": ("color_gamma", 1.0),
+}
+# ColorCorrect values that leave the image untouched
+COLOR_IDENTITY = {"temperature": 0.0, "contrast": 1.0, "saturation": 1.0, "gamma": 1.0}
+# Accepted request ranges (inclusive) for the post-processing params above
+POST_PROCESSING_RANGES = {
+    "haze_strength": (0.0, 1.0),
+    "lift_blacks": (0.0, 1.0),
+    "light_wrap_strength": (0.0, 1.0),
+    "chromatic_aberration": (0.0, 1.0),
+    "vignette_intensity": (0.0, 1.0),
+    "grain_intensity": (0.0, 1.0),
+    "highlight_rolloff": (0.0, 1.0),
+    "color_temperature": (-100.0, 100.0),
+    "color_contrast": (0.0, 2.0),
+    "color_saturation": (0.0, 2.0),
+    "color_gamma": (0.2, 2.2),
+}
+
+
 def inject_post_processing(wf: dict, image_source_node: str, save_node: str, params: dict):
     """Inject DepthAnythingV2 → OpticalRealism → ColorCorrect chain.
 
-    Inserts between image_source_node and save_node.
+    Inserts between image_source_node and save_node. Stages whose parameters
+    are all identity values are skipped — no depth pass when every optical
+    effect is zero, no ColorCorrect when the grade is neutral.
     Returns the final output node ID (for further chaining if needed).
     """
     if not params.get("optical_realism", True):
         return image_source_node
 
-    grain = params.get("grain_intensity", 0.008)
-    temperature = params.get("color_temperature", 6.0)
-    saturation = params.get("color_saturation", 0.93)
+    optical = {key: params.get(name, default) for key, (name, default) in OPTICAL_PARAMS.items()}
+    color = {key: params.get(name, default) for key, (name, default) in COLOR_PARAMS.items()}
+    needs_optical = any(optical.values())
+    needs_color = color != COLOR_IDENTITY
 
-    # Depth estimation for physically-grounded effects
-    wf["30"] = {
-        "class_type": "DepthAnythingV2Preprocessor",
-        "inputs": {
-            "image": [image_source_node, 0],
-            "ckpt_name": "depth_anything_v2_vitl.pth",
-            "resolution": 1024,
-        },
-        "_meta": {"title": "Depth Map (OpticalRealism)"},
-    }
+    last_node = image_source_node
 
-    # OpticalRealism — physics-based camera simulation
-    wf["31"] = {
-        "class_type": "OpticalRealism",
-        "inputs": {
-            "image": [image_source_node, 0],
-            "depth_map": ["30", 0],
-            "atmosphere_enabled": True,
-            "haze_strength": 0.10,
-            "lift_blacks": 0.06,
-            "depth_offset": 0.0,
-            "light_wrap_strength": 0.15,
-            "chromatic_aberration": 0.004,
-            "vignette_intensity": 0.10,
-            "grain_power": grain,
-            "monochrome_grain": True,
-            "highlight_rolloff": 0.04,
-        },
-        "_meta": {"title": "Optical Realism"},
-    }
+    if needs_optical:
+        # Depth estimation for physically-grounded effects
+        depth_node = _add_depth(wf, image_source_node, "30", "Depth Map (OpticalRealism)")
 
-    # Color grading — warm shift + slight desaturation for natural skin tones
-    wf["32"] = {
-        "class_type": "ColorCorrect",
-        "inputs": {
-            "image": ["31", 0],
-            "temperature": temperature,
-            "hue": 0.0,
-            "brightness": 0.0,
-            "contrast": 1.04,
-            "saturation": saturation,
-            "gamma": 1.0,
-        },
-        "_meta": {"title": "Color Grading"},
-    }
+        # OpticalRealism — physics-based camera simulation
+        wf["31"] = {
+            "class_type": "OpticalRealism",
+            "inputs": {
+                "image": [image_source_node, 0],
+                "depth_map": [depth_node, 0],
+                "atmosphere_enabled": True,
+                "haze_strength": optical["haze_strength"],
+                "lift_blacks": optical["lift_blacks"],
+                "depth_offset": 0.0,
+                "light_wrap_strength": optical["light_wrap_strength"],
+                "chromatic_aberration": optical["chromatic_aberration"],
+                "vignette_intensity": optical["vignette_intensity"],
+                "grain_power": optical["grain_power"],
+                "monochrome_grain": True,
+                "highlight_rolloff": optical["highlight_rolloff"],
+            },
+            "_meta": {"title": "Optical Realism"},
+        }
+        last_node = "31"
+
+    if needs_color:
+        # Color grading — warm shift + slight desaturation for natural skin tones
+        wf["32"] = {
+            "class_type": "ColorCorrect",
+            "inputs": {
+                "image": [last_node, 0],
+                "temperature": color["temperature"],
+                "hue": 0.0,
+                "brightness": 0.0,
+                "contrast": color["contrast"],
+                "saturation": color["saturation"],
+                "gamma": color["gamma"],
+            },
+            "_meta": {"title": "Color Grading"},
+        }
+        last_node = "32"
+
+    if last_node == image_source_node:
+        debug_log("Post-processing skipped: all parameters are identity")
+        return image_source_node
 
     # Rewire SaveImage to use post-processed output
     if save_node in wf:
         for key, val in wf[save_node].get("inputs", {}).items():
             if isinstance(val, list) and len(val) == 2 and val[0] == image_source_node and val[1] == 0:
-                wf[save_node]["inputs"][key] = ["32", 0]
+                wf[save_node]["inputs"][key] = [last_node, 0]
 
-    debug_log(f"Post-processing injected: grain={grain}, temp={temperature}, sat={saturation}")
-    return "32"
+    debug_log(f"Post-processing injected: grain={optical['grain_power']}, "
+              f"temp={color['temperature']}, sat={color['saturation']}, "
+              f"optical={needs_optical}, color={needs_color}")
+    return last_node
 
 
 # ──────────────────────────────────────────────
 # Detail Daemon: micro-detail injection
 # ──────────────────────────────────────────────
 
-def inject_detail_daemon(wf: dict, scheduler_node: str, sampler_node: str, params: dict):
+def inject_detail_daemon(wf: dict, scheduler_node: str, sampler_node: str, params: dict,
+                         idx: dict | None = None):
     """Inject DetailDaemonSamplerNode between BasicScheduler and SamplerCustomAdvanced.
 
     Modifies the sigma schedule to add micro-detail (skin pores, hair strands, fabric texture).
@@ -245,10 +608,11 @@ def inject_detail_daemon(wf: dict, scheduler_node: str, sampler_node: str, param
     }
 
     # Rewire SamplerCustomAdvanced: sampler input → Detail Daemon output
-    for node_id, node in wf.items():
-        if node.get("class_type") == "SamplerCustomAdvanced":
-            if node["inputs"].get("sampler") == [sampler_node, 0]:
-                node["inputs"]["sampler"] = ["40", 0]
+    if idx is None:
+        idx = _build_edge_index(wf)
+    _rewire(wf, idx, (sampler_node, 0), ("40", 0),
+            class_types=("SamplerCustomAdvanced",), keys=("sampler",))
+    _index_nodes(idx, wf, ["40"])
 
     debug_log(f"Detail Daemon injected: detail_amount={detail_amount}")
 
@@ -277,11 +641,12 @@ def inject_controlnet(wf: dict, positive_node: str, negative_node: str, params:
     current_neg = negative_node
     cn_node_counter = 50
 
-    # Load ControlNet model (shared across all control types)
-    wf["52"] = {
+    # Load ControlNet model (shared across all control types). Its ID sits
+    # outside the 50-58 range the control branches below allocate from.
+    wf["59"] = {
         "class_type": "ControlNetLoader",
         "inputs": {
-            "control_net_name": "flux-controlnet-union-pro-2.0.safetensors",
+            "control_net_name": CONTROLNET_NAME,
         },
         "_meta": {"title": "ControlNet Union Pro 2.0"},
     }
@@ -312,7 +677,7 @@ def inject_controlnet(wf: dict, positive_node: str, negative_node: str, params:
             "inputs": {
                 "positive": [current_pos, 0],
                 "negative": [current_neg, 0],
-                "control_net": ["52", 0],
+                "control_net": ["59", 0],
                 "vae": ["3", 0],
                 "image": [str(cn_node_counter + 1), 0],
                 "strength": cn_strength,
@@ -336,23 +701,16 @@ def inject_controlnet(wf: dict, positive_node: str, negative_node: str, params:
             "inputs": {"image": depth_filename},
             "_meta": {"title": "Depth Reference Image"},
         }
-        wf[str(cn_node_counter + 1)] = {
-            "class_type": "DepthAnythingV2Preprocessor",
-            "inputs": {
-                "image": [str(cn_node_counter), 0],
-                "ckpt_name": "depth_anything_v2_vitl.pth",
-                "resolution": 1024,
-            },
-            "_meta": {"title": "Depth Preprocessor (ControlNet)"},
-        }
+        depth_node = _add_depth(wf, str(cn_node_counter), str(cn_node_counter + 1),
+                                "Depth Preprocessor (ControlNet)")
         wf[str(cn_node_counter + 2)] = {
             "class_type": "ControlNetApplySD3",
             "inputs": {
                 "positive": [current_pos, 0],
                 "negative": [current_neg, 0],
-                "control_net": ["52", 0],
+                "control_net": ["59", 0],
                 "vae": ["3", 0],
-                "image": [str(cn_node_counter + 1), 0],
+                "image": [depth_node, 0],
                 "strength": depth_strength,
                 "start_percent": 0.0,
                 "end_percent": 0.6,
@@ -389,7 +747,7 @@ def inject_controlnet(wf: dict, positive_node: str, negative_node: str, params:
             "inputs": {
                 "positive": [current_pos, 0],
                 "negative": [current_neg, 0],
-                "control_net": ["52", 0],
+                "control_net": ["59", 0],
                 "vae": ["3", 0],
                 "image": [str(cn_node_counter + 1), 0],
                 "strength": canny_strength,
@@ -562,6 +920,196 @@ def inject_hires_fix(wf: dict, image_source_node: str, params: dict,
     return "76"
 
 
+# ──────────────────────────────────────────────
+# Face LoRA: existence check + LoraLoader injection
+# ──────────────────────────────────────────────
+
+LORA_DIRS = ("/runpod-volume/models/loras", "/comfyui/models/loras")
+
+
+# LoRA file name → directory it was seen in. Refreshed with one readdir per
+# directory on a miss, so files added to the network volume later are still
+# picked up; a hit is re-checked with one stat in case the file was removed.
+_lora_found: dict[str, str] = {}
+
+
+def _scan_lora_dirs() -> None:
+    """Rebuild _lora_found from the current contents of LORA_DIRS."""
+    found = {}
+    for d in reversed(LORA_DIRS):  # earlier directories win
+        try:
+            found.update(dict.fromkeys(os.listdir(d), d))
+        except OSError:
+            continue
+    _lora_found.clear()
+    _lora_found.update(found)
+
+
+def _lora_exists(name: str) -> bool:
+    """Check whether a LoRA file is present in any directory ComfyUI loads from."""
+    d = _lora_found.get(name)
+    if d is None or not os.path.isfile(os.path.join(d, name)):
+        _scan_lora_dirs()
+        d = _lora_found.get(name)
+    if d is not None and os.path.isfile(os.path.join(d, name)):
+        return True
+    # Names with a subfolder aren't in the top-level listing
+    return "/" in name and any(os.path.isfile(os.path.join(d, name)) for d in LORA_DIRS)
+
+
+def _face_lora_enabled(face_lora: str, strength: float) -> bool:
+    """Return True if the face LoRA is requested with non-zero strength and exists on disk."""
+    if not face_lora or strength == 0.0:
+        return False
+    if not _lora_exists(face_lora):
+        debug_log(f"WARNING: LoRA file '{face_lora}' not found, skipping LoRA injection")
+        return False
+    return True
+
+
+def _inject_lora(wf: dict, idx: dict, face_lora: str, strength: float) -> str:
+    """Insert LoraLoader "1b" after UNet "1" / CLIP "2" and rewire their consumers.
+
+    Model refs to "1" move to "1b" output 0, clip refs to "2" move to "1b"
+    output 1. Returns the new model source node ID.
+    """
+    wf["1b"] = {
+        "class_type": "LoraLoader",
+        "inputs": {
+            "model": ["1", 0],
+            "clip": ["2", 0],
+            "lora_name": face_lora,
+            "strength_model": strength,
+            "strength_clip": strength,
+        },
+        "_meta": {"title": "Face LoRA"},
+    }
+    _rewire(wf, idx, ("1", 0), ("1b", 0))
+    _rewire(wf, idx, ("2", 0), ("1b", 1))
+    _index_nodes(idx, wf, ["1b"])
+    return "1b"
+
+
+# ──────────────────────────────────────────────
+# LoRA auto-download
+# ──────────────────────────────────────────────
+
+LORA_DOWNLOAD_PARTS = 8
+LORA_RANGED_MIN_BYTES = 32 * 1024 * 1024  # smaller files aren't worth splitting
+_DL_HEADERS = {"User-Agent": "Mozilla/5.0"}
+
+
+def _download_stream(url: str, path: str) -> None:
+    """Download url to path over a single connection."""
+    req = urllib.request.Request(url, headers=_DL_HEADERS)
+    with urllib.request.urlopen(req, timeout=600) as resp, open(path, "wb", buffering=1 << 20) as f:
+        shutil.copyfileobj(resp, f, length=1 << 20)
+
+
+def _download_range(url: str, fd: int, start: int, end: int) -> None:
+    """Write bytes start..end (inclusive) of url into fd at the same offset."""
+    req = urllib.request.Request(url, headers={**_DL_HEADERS, "Range": f"bytes={start}-{end}"})
+    with urllib.request.urlopen(req, timeout=600) as resp:
+        if resp.status != 206:
+            raise ValueError(f"Range not honoured (HTTP {resp.status})")
+        offset = start
+        while True:
+            chunk = resp.read(1 << 20)
+            if not chunk:
+                break
+            os.pwrite(fd, chunk, offset)
+            offset += len(chunk)
+    if offset != end + 1:
+        raise IOError(f"Short range read: bytes {start}-{end} stopped at {offset}")
+
+
+def lora_file_name(url: str, name: str) -> str:
+    """File name a lora_url download is stored under: name plus a digest of url.
+
+    ComfyUI caches loaded LoRAs (and node outputs) by file name, so a new URL
+    must never overwrite a name a warm worker may already have loaded.
+    """
+    stem = name[:-len(".safetensors")] if name.endswith(".safetensors") else name
+    digest = hashlib.blake2b(url.encode(), digest_size=4).hexdigest()
+    return f"{stem}-{digest}.safetensors"
+
+
+def lora_is_current(url: str, dest: str) -> bool:
+    """True if dest holds a complete download of url.
+
+    Each download writes a dest + ".json" sidecar with its source URL and
+    size, so a different URL with the same basename or a truncated file is
+    re-fetched. Files from before sidecars existed are trusted as-is.
+    """
+    try:
+        with open(dest + ".json", "rb") as f:
+            meta = json_loads(f.read())
+    except FileNotFoundError:
+        return os.path.isfile(dest)
+    except (OSError, ValueError):
+        return False
+    try:
+        return meta.get("url") == url and os.path.getsize(dest) == meta.get("size")
+    except OSError:
+        return False
+
+
+def download_lora(url: str, dest: str) -> None:
+    """Download a LoRA to dest, splitting large files into parallel range requests.
+
+    Holds an exclusive lock on dest + ".lock" so concurrent requests for the
+    same LoRA wait for one download instead of each fetching it.
+    """
+    tmp = dest + ".tmp"
+    with open(dest + ".lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if lora_is_current(url, dest):
+            return
+        try:
+            # HEAD is only a probe for range support: presigned URLs are often
+            # signed for GET alone, so any failure means a plain single stream
+            total, ranged, etag = 0, False, ""
+            try:
+                head = urllib.request.Request(url, headers=_DL_HEADERS, method="HEAD")
+                with urllib.request.urlopen(head, timeout=30) as resp:
+                    final_url = resp.geturl()
+                    total = int(resp.headers.get("Content-Length") or 0)
+                    ranged = resp.headers.get("Accept-Ranges", "").lower() == "bytes"
+                    etag = resp.headers.get("ETag", "")
+            except (urllib.error.URLError, OSError, ValueError) as e:
+                debug_log(f"LoRA HEAD probe failed ({e}), using single stream")
+
+            if ranged and total >= LORA_RANGED_MIN_BYTES:
+                part = -(-total // LORA_DOWNLOAD_PARTS)
+                spans = [(s, min(s + part, total) - 1) for s in range(0, total, part)]
+                fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+                try:
+                    os.ftruncate(fd, total)
+                    with ThreadPoolExecutor(max_workers=len(spans)) as pool:
+                        list(pool.map(lambda span: _download_range(final_url, fd, *span), spans))
+                except ValueError as e:
+                    debug_log(f"LoRA ranged download unavailable ({e}), using single stream")
+                    os.close(fd)
+                    fd = -1
+                    _download_stream(url, tmp)
+                finally:
+                    if fd >= 0:
+                        os.close(fd)
+            else:
+                _download_stream(url, tmp)
+            os.rename(tmp, dest)
+            with open(dest + ".json", "wb") as f:
+                f.write(json_dumps({
+                    "url": url,
+                    "size": os.path.getsize(dest),
+                    "etag": etag,
+                }))
+        except Exception:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+
 # ──────────────────────────────────────────────
 # Workflow builders — Flux 1 Dev FP8 Architecture
 # ──────────────────────────────────────────────
@@ -598,6 +1146,7 @@ def build_generate_workflow(params: dict) -> dict:
       60 UpscaleModelLoader → 61 ImageUpscaleWithModel → 62 ImageScale
     """
     wf = load_workflow("txt2img-flux1")
+    idx = _build_edge_index(wf)
 
     # Core prompt
     prompt = params.get("prompt",
@@ -614,18 +1163,7 @@ def build_generate_workflow(params: dict) -> dict:
     ip_adapter_strength = params.get("ip_adapter_strength", 0.5)
     face_mode = params.get("face_mode", "pulid")  # "pulid" or "ip_adapter"
     pulid_strength = params.get("pulid_strength", 1.0)
-    skip_face_lora = not face_lora or face_lora_strength == 0.0
-
-    # Check if LoRA file actually exists on disk
-    if not skip_face_lora:
-        lora_paths = [
-            f"/runpod-volume/models/loras/{face_lora}",
-            f"/comfyui/models/loras/{face_lora}",
-        ]
-        lora_exists = any(os.path.isfile(p) for p in lora_paths)
-        if not lora_exists:
-            debug_log(f"WARNING: LoRA file '{face_lora}' not found, skipping LoRA injection")
-            skip_face_lora = True
+    skip_face_lora = not _face_lora_enabled(face_lora, face_lora_strength)
 
     # Auto-inject LoRA trigger word into prompt
     trigger_word = params.get("trigger_word", "MGNPERSON")
@@ -654,34 +1192,7 @@ def build_generate_workflow(params: dict) -> dict:
 
     # ── Inject Face LoRA node if provided (native ComfyUI LoraLoader) ──
     if not skip_face_lora:
-        wf["1b"] = {
-            "class_type": "LoraLoader",
-            "inputs": {
-                "model": ["1", 0],
-                "clip": ["2", 0],
-                "lora_name": face_lora,
-                "strength_model": face_lora_strength,
-                "strength_clip": face_lora_strength,
-            },
-            "_meta": {"title": "Face LoRA"},
-        }
-        # Rewire: all nodes that reference model from "1" → "1b"
-        for node_id, node in wf.items():
-            if node_id == "1b":
-                continue
-            inputs = node.get("inputs", {})
-            for key, val in inputs.items():
-                if isinstance(val, list) and len(val) == 2 and val[0] == "1" and val[1] == 0:
-                    inputs[key] = ["1b", 0]
-        # Also rewire clip references from "2" → "1b" output 1
-        for node_id, node in wf.items():
-            if node_id == "1b":
-                continue
-            inputs = node.get("inputs", {})
-            for key, val in inputs.items():
-                if isinstance(val, list) and len(val) == 2 and val[0] == "2" and val[1] == 0:
-                    inputs[key] = ["1b", 1]
-        current_model = "1b"
+        current_model = _inject_lora(wf, idx, face_lora, face_lora_strength)
         current_clip = "1b"  # output index 1
 
     # ── Inject face identity: PuLID or IP-Adapter ──
@@ -698,7 +1209,7 @@ def build_generate_workflow(params: dict) -> dict:
         wf["25"] = {
             "class_type": "PulidFluxModelLoader",
             "inputs": {
-                "pulid_file": "pulid_flux_v0.9.1.safetensors",
+                "pulid_file": PULID_FILE,
             },
             "_meta": {"title": "PuLID Model Loader"},
         }
@@ -732,13 +1243,8 @@ def build_generate_workflow(params: dict) -> dict:
             "_meta": {"title": "Apply PuLID-Flux"},
         }
         # Rewire downstream: current_model → "28"
-        for node_id, node in wf.items():
-            if node_id in ("1b", "20", "25", "26", "27", "28"):
-                continue
-            inputs = node.get("inputs", {})
-            for key, val in inputs.items():
-                if isinstance(val, list) and len(val) == 2 and val[0] == current_model and val[1] == 0:
-                    inputs[key] = ["28", 0]
+        _rewire(wf, idx, (current_model, 0), ("28", 0))
+        _index_nodes(idx, wf, ["20", "25", "26", "27", "28"])
         current_model = "28"
         debug_log(f"PuLID injected: ref={ref_filename}, weight={pulid_strength}")
 
@@ -771,13 +1277,8 @@ def build_generate_workflow(params: dict) -> dict:
             "_meta": {"title": "Apply IP-Adapter"},
         }
         # Rewire downstream nodes from current_model to "22"
-        for node_id, node in wf.items():
-            if node_id in ("1b", "20", "21", "22"):
-                continue
-            inputs = node.get("inputs", {})
-            for key, val in inputs.items():
-                if isinstance(val, list) and len(val) == 2 and val[0] == current_model and val[1] == 0:
-                    inputs[key] = ["22", 0]
+        _rewire(wf, idx, (current_model, 0), ("22", 0))
+        _index_nodes(idx, wf, ["20", "21", "22"])
         current_model = "22"
         debug_log(f"IP-Adapter injected: ref={ref_filename}, scale={ip_adapter_strength}")
 
@@ -785,52 +1286,49 @@ def build_generate_workflow(params: dict) -> dict:
     positive_node = "4"   # CLIPTextEncode positive
     negative_node = "14"  # CLIPTextEncode negative
 
+    before_cn = set(wf)
     positive_node, negative_node = inject_controlnet(wf, positive_node, negative_node, params)
+    _index_nodes(idx, wf, wf.keys() - before_cn)
 
-    # Rewire BasicGuider conditioning if ControlNet modified it
+    # Rewire BasicGuider conditioning + FaceDetailer positive/negative if ControlNet modified it
     if positive_node != "4":
-        for node_id, node in wf.items():
-            if node.get("class_type") == "BasicGuider":
-                if node["inputs"].get("conditioning") == ["4", 0]:
-                    node["inputs"]["conditioning"] = [positive_node, 0]
-        # Also rewire FaceDetailer positive/negative
-        for node_id, node in wf.items():
-            if node.get("class_type") == "FaceDetailer":
-                if node["inputs"].get("positive") == ["4", 0]:
-                    node["inputs"]["positive"] = [positive_node, 0]
-                if node["inputs"].get("negative") == ["14", 0]:
-                    node["inputs"]["negative"] = [negative_node, 1]
+        _rewire(wf, idx, ("4", 0), (positive_node, 0),
+                class_types=("BasicGuider",), keys=("conditioning",))
+        _rewire(wf, idx, ("4", 0), (positive_node, 0),
+                class_types=("FaceDetailer",), keys=("positive",))
+        _rewire(wf, idx, ("14", 0), (negative_node, 1),
+                class_types=("FaceDetailer",), keys=("negative",))
 
     # ── Inject Detail Daemon ──
-    inject_detail_daemon(wf, scheduler_node="8", sampler_node="7", params=params)
+    inject_detail_daemon(wf, scheduler_node="8", sampler_node="7", params=params, idx=idx)
 
     # ── Apply parameters to workflow nodes ──
-    for node_id, node in wf.items():
-        class_type = node.get("class_type", "")
+    tidx = _template_index("txt2img-flux1")
 
-        # CLIPTextEncode — positive prompt
-        if class_type == "CLIPTextEncode" and "positive" in node.get("_meta", {}).get("title", "").lower():
-            node["inputs"]["text"] = prompt
+    # CLIPTextEncode — positive prompt
+    for nid in tidx.get("positive_prompt", ()):
+        wf[nid]["inputs"]["text"] = prompt
 
-        # RandomNoise — seed
-        if class_type == "RandomNoise":
-            node["inputs"]["noise_seed"] = seed
+    # RandomNoise — seed
+    for nid in tidx.get("RandomNoise", ()):
+        wf[nid]["inputs"]["noise_seed"] = seed
 
-        # BasicScheduler — steps
-        if class_type == "BasicScheduler":
-            node["inputs"]["steps"] = steps
+    # BasicScheduler — steps
+    for nid in tidx.get("BasicScheduler", ()):
+        wf[nid]["inputs"]["steps"] = steps
 
-        # EmptySD3LatentImage — dimensions
-        if class_type == "EmptySD3LatentImage":
-            node["inputs"]["width"] = width
-            node["inputs"]["height"] = height
+    # EmptySD3LatentImage — dimensions
+    for nid in tidx.get("EmptySD3LatentImage", ()):
+        wf[nid]["inputs"]["width"] = width
+        wf[nid]["inputs"]["height"] = height
 
-        # FaceDetailer
-        if class_type == "FaceDetailer":
-            node["inputs"]["denoise"] = fd_denoise
-            node["inputs"]["seed"] = seed
-            if "feather" in node["inputs"]:
-                node["inputs"]["feather"] = fd_feather
+    # FaceDetailer
+    for nid in tidx.get("FaceDetailer", ()):
+        inputs = wf[nid]["inputs"]
+        inputs["denoise"] = fd_denoise
+        inputs["seed"] = seed
+        if "feather" in inputs:
+            inputs["feather"] = fd_feather
 
     # ── Hires Fix (upscale + second pass) or simple upscale ──
     if params.get("hires_fix", True):
@@ -853,6 +1351,7 @@ def build_edit_workflow(params: dict) -> dict:
       - FaceDetailer included
     """
     wf = load_workflow("img2img-flux1")
+    idx = _build_edge_index(wf)
 
     prompt = params.get("prompt", "")
     denoise = params.get("denoise", 0.6)
@@ -863,17 +1362,7 @@ def build_edit_workflow(params: dict) -> dict:
 
     face_lora = params.get("face_lora", "")
     face_lora_strength = params.get("face_lora_strength", 0.0)
-    skip_face_lora = not face_lora or face_lora_strength == 0.0
-
-    # Check if LoRA file actually exists on disk
-    if not skip_face_lora:
-        lora_paths = [
-            f"/runpod-volume/models/loras/{face_lora}",
-            f"/comfyui/models/loras/{face_lora}",
-        ]
-        if not any(os.path.isfile(p) for p in lora_paths):
-            debug_log(f"WARNING: LoRA file '{face_lora}' not found, skipping LoRA injection")
-            skip_face_lora = True
+    skip_face_lora = not _face_lora_enabled(face_lora, face_lora_strength)
 
     # Upload input image to ComfyUI
     input_image_b64 = params.get("input_image", "")
@@ -886,55 +1375,34 @@ def build_edit_workflow(params: dict) -> dict:
 
     # ── Inject Face LoRA node if provided (native ComfyUI LoraLoader) ──
     if not skip_face_lora:
-        wf["1b"] = {
-            "class_type": "LoraLoader",
-            "inputs": {
-                "model": ["1", 0],
-                "clip": ["2", 0],
-                "lora_name": face_lora,
-                "strength_model": face_lora_strength,
-                "strength_clip": face_lora_strength,
-            },
-            "_meta": {"title": "Face LoRA"},
-        }
-        for node_id, node in wf.items():
-            if node_id == "1b":
-                continue
-            inputs = node.get("inputs", {})
-            for key, val in inputs.items():
-                if isinstance(val, list) and len(val) == 2 and val[0] == "1" and val[1] == 0:
-                    inputs[key] = ["1b", 0]
-            for key, val in inputs.items():
-                if isinstance(val, list) and len(val) == 2 and val[0] == "2" and val[1] == 0:
-                    inputs[key] = ["1b", 1]
+        _inject_lora(wf, idx, face_lora, face_lora_strength)
 
     # ── Inject Detail Daemon ──
-    inject_detail_daemon(wf, scheduler_node="10", sampler_node="9", params=params)
+    inject_detail_daemon(wf, scheduler_node="10", sampler_node="9", params=params, idx=idx)
 
     # ── Apply parameters to workflow nodes ──
-    for node_id, node in wf.items():
-        class_type = node.get("class_type", "")
+    tidx = _template_index("img2img-flux1")
 
-        # CLIPTextEncode — positive prompt
-        if class_type == "CLIPTextEncode" and "positive" in node.get("_meta", {}).get("title", "").lower():
-            node["inputs"]["text"] = prompt
+    # CLIPTextEncode — positive prompt
+    for nid in tidx.get("positive_prompt", ()):
+        wf[nid]["inputs"]["text"] = prompt
 
-        # RandomNoise — seed
-        if class_type == "RandomNoise":
-            node["inputs"]["noise_seed"] = seed
+    # RandomNoise — seed
+    for nid in tidx.get("RandomNoise", ()):
+        wf[nid]["inputs"]["noise_seed"] = seed
 
-        # BasicScheduler — steps + denoise
-        if class_type == "BasicScheduler":
-            node["inputs"]["steps"] = steps
-            node["inputs"]["denoise"] = denoise
+    # BasicScheduler — steps + denoise
+    for nid in tidx.get("BasicScheduler", ()):
+        wf[nid]["inputs"]["steps"] = steps
+        wf[nid]["inputs"]["denoise"] = denoise
 
-        # LoadImage — input image
-        if class_type == "LoadImage":
-            node["inputs"]["image"] = input_filename
+    # LoadImage — input image
+    for nid in tidx.get("LoadImage", ()):
+        wf[nid]["inputs"]["image"] = input_filename
 
-        # FaceDetailer
-        if class_type == "FaceDetailer":
-            node["inputs"]["seed"] = seed
+    # FaceDetailer
+    for nid in tidx.get("FaceDetailer", ()):
+        wf[nid]["inputs"]["seed"] = seed
 
     # ── Upscale (optional) ──
     last_image = inject_upscale(wf, image_source_node="16", params=params)
@@ -969,19 +1437,19 @@ def build_detailer_workflow(params: dict) -> dict:
     if not input_filename:
         raise ValueError("input_image is required for detailer action")
 
-    for node_id, node in wf.items():
-        class_type = node.get("class_type", "")
+    tidx = _template_index("detailer-upscale-flux1")
 
-        if class_type == "LoadImage":
-            node["inputs"]["image"] = input_filename
+    for nid in tidx.get("LoadImage", ()):
+        wf[nid]["inputs"]["image"] = input_filename
 
-        if class_type == "FaceDetailer":
-            node["inputs"]["denoise"] = fd_denoise
-            if "seed" in node["inputs"]:
-                node["inputs"]["seed"] = seed
+    for nid in tidx.get("FaceDetailer", ()):
+        inputs = wf[nid]["inputs"]
+        inputs["denoise"] = fd_denoise
+        if "seed" in inputs:
+            inputs["seed"] = seed
 
-        if class_type == "ImageScaleBy":
-            node["inputs"]["scale_by"] = scale_by
+    for nid in tidx.get("ImageScaleBy", ()):
+        wf[nid]["inputs"]["scale_by"] = scale_by
 
     # ── Post-processing: OpticalRealism + ColorCorrect ──
     inject_post_processing(wf, image_source_node="12", save_node="13", params=params)
@@ -993,32 +1461,317 @@ def build_detailer_workflow(params: dict) -> dict:
 # Image upload helper
 # ──────────────────────────────────────────────
 
-def upload_reference_image(image_b64: str) -> str:
-    """Upload a base64 image to ComfyUI and return filename."""
-    img_bytes = base64.b64decode(image_b64)
-    filename = f"ref_{uuid.uuid4().hex[:8]}.png"
+# Content-addressed cache of uploads: digest of the base64 payload → ComfyUI
+# input filename. Inputs live for the container's lifetime, so repeat
+# references (same face across many prompts) skip decode + upload entirely.
+_ref_cache: dict[bytes, str] = {}
+_ref_tmp_seq = itertools.count()  # unique temp names without a urandom read
 
+
+def upload_reference_image(image_b64: str | bytes) -> str:
+    """Upload a base64 image to ComfyUI and return filename."""
+    # Encode once; both the digest and the decoder take the ASCII bytes
+    if isinstance(image_b64, str):
+        image_b64 = image_b64.encode("ascii")
+    digest = hashlib.blake2b(image_b64, digest_size=16).digest()
+    cached = _ref_cache.get(digest)
+    if cached is not None:
+        debug_log(f"Reference image cache hit: {cached}")
+        return cached
+
+    filename = f"ref_{digest.hex()[:16]}.png"
+
+    # ComfyUI runs in this container: write straight into its input dir and
+    # skip the multipart round trip. Names are content-addressed, so an
+    # existing file already holds these bytes.
+    if os.path.isdir(COMFYUI_INPUT_DIR):
+        path = os.path.join(COMFYUI_INPUT_DIR, filename)
+        if not os.path.exists(path):
+            tmp = f"{path}.{os.getpid()}.{next(_ref_tmp_seq):x}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(base64.b64decode(image_b64, validate=False))
+            os.replace(tmp, path)
+        _ref_cache[digest] = filename
+        return filename
+
+    # Grow one buffer in place; `a + img + b` would copy the image twice
     boundary = uuid.uuid4().hex
-    body = (
+    body = bytearray(
         f"--{boundary}\r\n"
         f'Content-Disposition: form-data; name="image"; filename="{filename}"\r\n'
-        f"Content-Type: image/png\r\n\r\n"
-    ).encode() + img_bytes + f"\r\n--{boundary}--\r\n".encode()
+        f"Content-Type: image/png\r\n\r\n".encode()
+    )
+    body += base64.b64decode(image_b64, validate=False)
+    body += f"\r\n--{boundary}--\r\n".encode()
 
-    req = urllib.request.Request(
+    resp = _http.request(
+        "POST",
         f"{COMFYUI_URL}/upload/image",
-        data=body,
+        body=body,
         headers={"Content-Type": f"multipart/form-data; boundary={boundary}"},
+        timeout=30.0,
     )
-    resp = urllib.request.urlopen(req, timeout=30)
-    result = json.loads(resp.read())
-    return result.get("name", filename)
+    result = json_loads(resp.data)
+    name = result.get("name", filename)
+    _ref_cache[digest] = name
+    return name
+
+
+# ──────────────────────────────────────────────
+# Worker warmup
+# ──────────────────────────────────────────────
+
+WORKFLOW_TEMPLATES = ("txt2img-flux1", "img2img-flux1", "detailer-upscale-flux1")
+
+
+def preload_templates() -> None:
+    """Read, parse and index every workflow template before the first request."""
+    for name in WORKFLOW_TEMPLATES:
+        try:
+            _template_index(name)
+        except FileNotFoundError as e:
+            debug_log(f"Template preload skipped: {e}")
+
+
+def prime_connection() -> None:
+    """Open a keep-alive connection to ComfyUI so the first request skips the handshake."""
+    try:
+        _http.request("GET", f"{COMFYUI_URL}/system_stats", timeout=2.0)
+    except urllib3.exceptions.HTTPError as e:
+        debug_log(f"ComfyUI preconnect failed: {e}")
+
+
+def warmup() -> None:
+    """Queue a tiny workflow that touches the optional model files once.
+
+    Runs the 4x-UltraSharp upscaler and DepthAnythingV2 on a 64×64 blank
+    image so their weights are read off the network volume (and the depth
+    checkpoint fetched) before the first real request. Fire-and-forget:
+    ComfyUI runs it ahead of any request queued after it.
+
+    ControlNet/PuLID loaders are left out — ComfyUI only executes nodes that
+    feed an output, and wiring them up would need a full sampling pass.
+    """
+    wf = {
+        "1": {
+            "class_type": "EmptyImage",
+            "inputs": {"width": 64, "height": 64, "batch_size": 1, "color": 0},
+        },
+        "2": {
+            "class_type": "UpscaleModelLoader",
+            "inputs": {"model_name": "4x-UltraSharp.pth"},
+        },
+        "3": {
+            "class_type": "ImageUpscaleWithModel",
+            "inputs": {"upscale_model": ["2", 0], "image": ["1", 0]},
+        },
+        "4": {"class_type": "PreviewImage", "inputs": {"images": ["3", 0]}},
+        "6": {"class_type": "PreviewImage", "inputs": {"images": ["5", 0]}},
+    }
+    _add_depth(wf, image_node="1", node_id="5", title="Warmup Depth", resolution=64)
+    try:
+        prompt_id = queue_prompt(wf, _CLIENT_ID)
+        debug_log(f"Warmup queued: prompt_id={prompt_id}")
+    except Exception as e:
+        debug_log(f"Warmup skipped: {e}")
+
+
+# ──────────────────────────────────────────────
+# Result cache
+# ──────────────────────────────────────────────
+
+# Finished results keyed by a digest of the built workflow + output options.
+# Only seeded requests are cached: same graph + same seed → same pixels, so
+# retries and repeat QA runs skip the GPU entirely. Bounded by the total size
+# of the cached base64 images; off unless RESULT_CACHE_MB is set.
+RESULT_CACHE_BYTES = int(float(os.environ.get("RESULT_CACHE_MB", "0")) * 1024 * 1024)
+_result_cache: OrderedDict[bytes, tuple[dict, int]] = OrderedDict()
+_result_cache_bytes = 0
+
+
+def _lora_stamp(name: str) -> list | None:
+    """(size, mtime_ns) of the LoRA file ComfyUI will load, or None if absent.
+
+    A re-download or manual replacement on the volume keeps the file name,
+    so the graph alone can't tell old weights from new.
+    """
+    for d in LORA_DIRS:
+        try:
+            st = os.stat(os.path.join(d, name))
+        except OSError:
+            continue
+        return [st.st_size, st.st_mtime_ns]
+    return None
+
+
+def _result_key(workflow: dict, params: dict) -> bytes:
+    """Digest of everything that determines the response images."""
+    loras = [
+        _lora_stamp(node["inputs"]["lora_name"])
+        for node in workflow.values()
+        if node.get("class_type") == "LoraLoader"
+    ]
+    payload = json_dumps([workflow, loras, params.get("output_format"), params.get("quality")])
+    return hashlib.blake2b(payload, digest_size=16).digest()
+
+
+def _result_cache_get(key: bytes) -> dict | None:
+    entry = _result_cache.get(key)
+    if entry is None:
+        return None
+    _result_cache.move_to_end(key)
+    return entry[0]
+
+
+def _result_cache_put(key: bytes, result: dict) -> None:
+    global _result_cache_bytes
+    size = sum(len(img) for img in result["images"])
+    if size > RESULT_CACHE_BYTES or key in _result_cache:
+        return
+    _result_cache[key] = (result, size)
+    _result_cache_bytes += size
+    while _result_cache_bytes > RESULT_CACHE_BYTES:
+        _, (_, evicted) = _result_cache.popitem(last=False)
+        _result_cache_bytes -= evicted
+
+
+# ──────────────────────────────────────────────
+# Diagnostics (INFLUENCER_DEBUG=1)
+# ──────────────────────────────────────────────
+
+@functools.lru_cache(maxsize=1)
+def _extra_model_paths_yaml() -> str | None:
+    """Read ComfyUI's extra_model_paths.yaml once per worker."""
+    yaml_path = "/comfyui/extra_model_paths.yaml"
+    if not os.path.exists(yaml_path):
+        return None
+    with open(yaml_path) as f:
+        return f.read()
+
+
+# class_type substrings whose nodes are dumped in the per-request debug log
+DEBUG_NODE_KEYWORDS = (
+    "unet", "clip", "vae", "lora", "sam", "ultralytics", "guider", "scheduler",
+    "sampler", "ipadapter", "ip_adapter", "pulid", "controlnet", "detail", "upscale",
+)
+_DEBUG_NODE_RE = re.compile("|".join(DEBUG_NODE_KEYWORDS))
+
+
+DEBUG_MODEL_DIRS = (
+    "/runpod-volume/models/text_encoders",
+    "/runpod-volume/models/diffusion_models",
+    "/runpod-volume/models/unet",
+    "/runpod-volume/models/vae",
+    "/runpod-volume/models/loras",
+    "/runpod-volume/models/sams",
+    "/runpod-volume/models/ultralytics/bbox",
+    "/runpod-volume/models/clip_vision",
+    "/runpod-volume/models/xlabs/ipadapters",
+    "/runpod-volume/models/controlnet",
+    "/runpod-volume/models/pulid",
+    "/runpod-volume/models/clip",
+)
+DEBUG_LOADER_TYPES = ("UNETLoader", "DualCLIPLoader", "VAELoader")
+
+
+DEBUG_DIR_MAX_ENTRIES = 20
+
+
+def _probe_dir(d: str) -> str:
+    try:
+        it = os.scandir(d)
+    except (FileNotFoundError, NotADirectoryError):
+        return f"DIR {d}: MISSING"
+    names = []
+    with it:
+        for entry in it:
+            if len(names) == DEBUG_DIR_MAX_ENTRIES:
+                names.append("...")
+                break
+            names.append(entry.name)
+    return f"DIR {d}: {names}"
+
+
+def _probe_loader(node_type: str) -> str:
+    try:
+        resp = _http.request("GET", f"{COMFYUI_URL}/object_info/{node_type}", timeout=10.0)
+        info = json_loads(resp.data)
+        first_input = list(info.get(node_type, {}).get("input", {}).get("required", {}).values())
+        return f"ComfyUI {node_type} available: {first_input[0] if first_input else 'N/A'}"
+    except Exception as e:
+        return f"Could not query {node_type}: {e}"
+
+
+def log_environment() -> None:
+    """Log model directories and what ComfyUI's loaders can see.
+
+    Lists a dozen network-volume directories and makes several /object_info
+    calls, so it only runs when DEBUG is set. The probes are independent and
+    run concurrently on _io_pool; results are logged in a fixed order.
+    """
+    dirs = _io_pool.map(_probe_dir, DEBUG_MODEL_DIRS)
+    loaders = _io_pool.map(_probe_loader, DEBUG_LOADER_TYPES)
+
+    for line in dirs:
+        debug_log(line)
+
+    # Debug: check extra_model_paths
+    yaml_text = _extra_model_paths_yaml()
+    if yaml_text is not None:
+        debug_log(f"extra_model_paths.yaml:\n{yaml_text}")
+
+    for line in loaders:
+        debug_log(line)
 
 
 # ──────────────────────────────────────────────
 # Main handler
 # ──────────────────────────────────────────────
 
+WORKFLOW_BUILDERS = {
+    "generate": build_generate_workflow,
+    "edit": build_edit_workflow,
+    "detailer": build_detailer_workflow,
+}
+
+# Base64 image fields each action uploads to ComfyUI
+ACTION_UPLOADS = {
+    "generate": ("reference_image", "pose_image", "depth_image", "canny_image"),
+    "edit": ("reference_image", "input_image"),
+    "detailer": ("reference_image", "input_image"),
+}
+
+# Required input fields per action, checked before any download or upload
+ACTION_REQUIRED_PARAMS = {
+    "generate": (),
+    "edit": ("input_image",),
+    "detailer": ("input_image",),
+    "download_lora": (),
+}
+
+
+def validate_params(action: str, params: dict) -> str | None:
+    """Return an error message if the request can't succeed, else None."""
+    required = ACTION_REQUIRED_PARAMS.get(action)
+    if required is None:
+        return f"Unknown action: {action}"
+    for key in required:
+        if not params.get(key):
+            return f"{key} is required for {action} action"
+    if "quality" in params:
+        try:
+            int(params["quality"])
+        except (TypeError, ValueError):
+            return "quality must be an integer between 1 and 100"
+    for key, (lo, hi) in POST_PROCESSING_RANGES.items():
+        if key not in params:
+            continue
+        value = params[key]
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or not lo <= value <= hi:
+            return f"{key} must be a number between {lo:g} and {hi:g}"
+    return None
+
+
 def handler(event: dict) -> dict:
     """RunPod serverless handler entry point."""
     try:
@@ -1027,71 +1780,42 @@ def handler(event: dict) -> dict:
         debug_log(f"=== REQUEST START === action={action}")
         debug_log(f"Params: prompt={params.get('prompt', '')[:80]}...")
 
-        # Debug: check model directories
-        for d in ["/runpod-volume/models/text_encoders",
-                  "/runpod-volume/models/diffusion_models",
-                  "/runpod-volume/models/unet",
-                  "/runpod-volume/models/vae",
-                  "/runpod-volume/models/loras",
-                  "/runpod-volume/models/sams",
-                  "/runpod-volume/models/ultralytics/bbox",
-                  "/runpod-volume/models/clip_vision",
-                  "/runpod-volume/models/xlabs/ipadapters",
-                  "/runpod-volume/models/controlnet",
-                  "/runpod-volume/models/pulid",
-                  "/runpod-volume/models/clip"]:
-            if os.path.isdir(d):
-                files = os.listdir(d)
-                debug_log(f"DIR {d}: {files}")
-            else:
-                debug_log(f"DIR {d}: MISSING")
+        if DEBUG:
+            log_environment()
 
-        # Debug: check extra_model_paths
-        yaml_path = "/comfyui/extra_model_paths.yaml"
-        if os.path.exists(yaml_path):
-            with open(yaml_path) as f:
-                debug_log(f"extra_model_paths.yaml:\n{f.read()}")
+        error = validate_params(action, params)
+        if error:
+            debug_log(f"INVALID REQUEST: {error}")
+            return {"error": error}
 
-        # Debug: ask ComfyUI what models it sees
-        for node_type in ["UNETLoader", "DualCLIPLoader", "VAELoader"]:
-            try:
-                resp = urllib.request.urlopen(f"{COMFYUI_URL}/object_info/{node_type}", timeout=10)
-                info = json.loads(resp.read())
-                first_input = list(info.get(node_type, {}).get("input", {}).get("required", {}).values())
-                debug_log(f"ComfyUI {node_type} available: {first_input[0] if first_input else 'N/A'}")
-            except Exception as e:
-                debug_log(f"Could not query {node_type}: {e}")
+        # Start image uploads now so they overlap each other and the LoRA
+        # download; builders then hit _ref_cache instead of re-uploading
+        uploads = {
+            key: _io_pool.submit(upload_reference_image, params[key])
+            for key in ACTION_UPLOADS.get(action, ())
+            if params.get(key)
+        }
 
         # ── Auto-download LoRA from URL if provided ──
         lora_url = params.get("lora_url", "")
         if lora_url:
-            # Extract filename from URL
-            lora_name = params.get("lora_name", lora_url.rstrip("/").split("/")[-1])
-            if not lora_name.endswith(".safetensors"):
-                lora_name += ".safetensors"
+            # Extract filename from URL; stored under a URL-specific name
+            lora_name = lora_file_name(
+                lora_url, params.get("lora_name", lora_url.rstrip("/").split("/")[-1]))
             lora_dir = "/runpod-volume/models/loras"
             os.makedirs(lora_dir, exist_ok=True)
             dest = os.path.join(lora_dir, lora_name)
 
-            if os.path.isfile(dest):
+            if lora_is_current(lora_url, dest):
                 debug_log(f"LoRA already on disk: {dest}")
             else:
                 debug_log(f"Auto-downloading LoRA: {lora_url} -> {dest}")
                 try:
-                    req = urllib.request.Request(lora_url, headers={"User-Agent": "Mozilla/5.0"})
-                    with urllib.request.urlopen(req, timeout=600) as resp, open(dest + ".tmp", "wb") as f:
-                        while True:
-                            chunk = resp.read(131072)
-                            if not chunk:
-                                break
-                            f.write(chunk)
-                    os.rename(dest + ".tmp", dest)
+                    download_lora(lora_url, dest)
                     size_mb = os.path.getsize(dest) / (1024 * 1024)
                     debug_log(f"LoRA downloaded: {dest} ({size_mb:.1f} MB)")
                 except Exception as e:
                     debug_log(f"LoRA auto-download failed: {e}")
-                    if os.path.exists(dest + ".tmp"):
-                        os.remove(dest + ".tmp")
 
             # Map lora_url params to face_lora params for workflow builder
             if not params.get("face_lora"):
@@ -1103,39 +1827,47 @@ def handler(event: dict) -> dict:
         if params.get("face_lora") and not params.get("face_lora_strength"):
             params["face_lora_strength"] = 0.85
 
-        # Upload reference image for PuLID/IP-Adapter if provided
-        ref_image_b64 = params.get("reference_image")
-        ref_filename = None
-        if ref_image_b64:
-            ref_filename = upload_reference_image(ref_image_b64)
+        for future in uploads.values():
+            future.result()
+
+        # Reference image for PuLID/IP-Adapter
+        if "reference_image" in uploads:
+            ref_filename = uploads["reference_image"].result()
             params["_ref_filename"] = ref_filename
             debug_log(f"Uploaded reference image: {ref_filename}")
 
         # Utility action: download a LoRA file to the volume
         if action == "download_lora":
-            return {"status": "ok", "path": os.path.join("/runpod-volume/models/loras", params.get("face_lora", "")), "message": "LoRA ready"}
+            return {"status": "ok", "path": os.path.join("/runpod-volume/models/loras", params.get("face_lora", "")),
+                    "face_lora": params.get("face_lora", ""), "message": "LoRA ready"}
 
         # Build workflow based on action
-        if action == "generate":
-            workflow = build_generate_workflow(params)
-        elif action == "edit":
-            workflow = build_edit_workflow(params)
-        elif action == "detailer":
-            workflow = build_detailer_workflow(params)
-        else:
-            return {"error": f"Unknown action: {action}"}
+        workflow = WORKFLOW_BUILDERS[action](params)
 
         # Debug: log key workflow nodes
-        for node_id, node in workflow.items():
-            ct = node.get("class_type", "")
-            if any(k in ct.lower() for k in ["unet", "clip", "vae", "lora", "sam", "ultralytics", "guider", "scheduler", "sampler", "ipadapter", "ip_adapter", "pulid", "controlnet", "detail", "upscale"]):
-                debug_log(f"Node {node_id} ({ct}): {json.dumps(node.get('inputs', {}))[:200]}")
-
-        # Queue and wait
+        if DEBUG:
+            for node_id, node in workflow.items():
+                ct = node.get("class_type", "")
+                if _DEBUG_NODE_RE.search(ct.lower()):
+                    debug_log(f"Node {node_id} ({ct}): {json.dumps(node.get('inputs', {}))[:200]}")
+
+        result_key = None
+        if params.get("seed", -1) != -1 and RESULT_CACHE_BYTES > 0:
+            result_key = _result_key(workflow, params)
+            cached = _result_cache_get(result_key)
+            if cached is not None:
+                debug_log(f"=== REQUEST CACHED === prompt_id={cached['prompt_id']}")
+                return cached
+
+        # Queue and wait — subscribe first so no completion event is missed
         debug_log("Queueing workflow...")
-        prompt_id = queue_prompt(workflow)
+        ws = get_websocket()
+        prompt_id = queue_prompt(workflow, _CLIENT_ID)
         debug_log(f"Queued: prompt_id={prompt_id}")
-        history = poll_completion(prompt_id)
+        if ws is not None:
+            history = wait_for_completion(ws, prompt_id)
+        else:
+            history = poll_completion(prompt_id)
 
         # Check for errors
         status = history.get("status", {})
@@ -1145,7 +1877,7 @@ def handler(event: dict) -> dict:
             return {"error": "Workflow execution failed", "details": messages}
 
         # Extract output images
-        images = get_output_images(history)
+        images = get_output_images(history, params)
         debug_log(f"Output: {len(images)} images")
 
         if not images:
@@ -1153,11 +1885,14 @@ def handler(event: dict) -> dict:
             return {"error": "No output images produced"}
 
         debug_log(f"=== REQUEST SUCCESS === {len(images)} images, seed={params.get('seed', -1)}")
-        return {
+        result = {
             "images": images,
             "prompt_id": prompt_id,
             "seed": params.get("seed", -1),
         }
+        if result_key is not None:
+            _result_cache_put(result_key, result)
+        return result
 
     except TimeoutError as e:
         debug_log(f"TIMEOUT: {e}")
@@ -1171,4 +1906,11 @@ def handler(event: dict) -> dict:
 
 
 # RunPod serverless entry
-runpod.serverless.start({"handler": handler})
+if __name__ == "__main__":
+    import runpod
+
+    preload_templates()
+    prime_connection()
+    if os.environ.get("WARMUP", "1") == "1":
+        warmup()
+    runpod.serverless.start({"handler": handler})
@@ -4,7 +4,6 @@
 ComfyUI v0.15 renamed folder_paths key from 'unet' to 'diffusion_models'.
 This patch adds a safe fallback so the node works with both old and new versions.
 """
-import sys
 
 target = "/comfyui/custom_nodes/ComfyUI-GGUF-LoRA-Load/nodes.py"
 
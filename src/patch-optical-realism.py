@@ -7,7 +7,6 @@ Two unsqueeze(0) then creates 5D which F.interpolate can't handle.
 
 Fix: use unsqueeze(1) for 3D tensors (adds channel dim, not extra batch).
 """
-import sys
 
 target = "/comfyui/custom_nodes/ComfyUI-Optical-Realism/optical_realism.py"
 